@@ -6,6 +6,12 @@ import os
 import sqlite3
 import time
 import html
+import threading
+import atexit
+import itertools
+import queue
+import mmap
+import math
 from urllib.parse import urlparse, urljoin, quote, unquote_plus
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -15,7 +21,9 @@ from xml.etree.ElementTree import Element, SubElement, tostring
 from xml.dom import minidom
 from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.background import BackgroundScheduler
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
@@ -25,6 +33,43 @@ app = Flask(__name__)
 DL_CONFIG_DB = 'DLConfig.db'
 UPDATE_INTERVAL_HOURS = 12
 
+# Channel health prober
+PROBE_INTERVAL_MINUTES = 30
+PROBE_MAX_WORKERS = 4          # Channels resolved in parallel
+PROBE_RATE_PER_SECOND = 1.0    # Max probe starts per second across all workers
+PREWARM_TOP_CHANNELS = 10      # Most-watched channels resolved into stream_cache at startup
+DEAD_AFTER_FAILURES = 3        # Consecutive failed probes before a channel counts as dead
+VIEW_FLUSH_MINUTES = 5         # How often playlist view counts are saved to the DB
+DEAD_CHANNEL_MODE = 'show'     # show | flag | hide (override per M3U with ?dead=...)
+PROBE_SKIP_OUTPUT_FILES = ('Unassigned.m3u', 'Notwanted.m3u')  # Not probed unless someone watches them
+
+# Proxy admission control
+MAX_UPSTREAM_REQUESTS = 32     # Upstream fetches/resolves in flight across all clients
+MAX_CLIENT_REQUESTS = 6        # Upstream fetches/resolves in flight per client IP
+MAX_QUEUED_REQUESTS = 64       # Requests allowed to wait for a slot before answering 503
+QUEUE_TIMEOUT_SECONDS = 10
+RETRY_AFTER_SECONDS = 5
+ACTIVE_STREAM_SECONDS = 30     # A client that fetched a channel this recently is already playing it
+BANDWIDTH_LIMIT_KBPS = 0       # Shared budget for segment relays (0 = unlimited)
+BANDWIDTH_BURST_KB = 4096
+
+# Continuous MPEG-TS endpoint
+TS_VIEWER_BUFFER_SEGMENTS = 6  # Segments queued per viewer; a slow viewer skips the oldest
+TS_STALL_SECONDS = 30          # End a viewer's stream if no segment arrives for this long
+TS_IDLE_SECONDS = 15           # A channel reader stops this long after its last viewer leaves
+
+# Multi-variant playlists
+DEFAULT_MAX_BITRATE = 0        # Variant cap in bits/s when a client gives no ?max_bitrate= (0 = best)
+OUTPUT_FILE_MAX_BITRATE = {}   # Per output M3U cap, e.g. {'SportENGLISH.m3u': 3000000}
+MASTER_PLAYLIST_CACHE_SECONDS = 30
+
+# Disk segment spool for time-shift; disabled unless SPOOL_DIR is set
+SPOOL_DIR = os.environ.get('SPOOL_DIR', '')
+SPOOL_WINDOW_MINUTES = 30      # Segments older than this are dropped from a channel's spool
+SPOOL_CHANNEL_MB = 512         # Ring buffer file size per channel
+SPOOL_TOTAL_MB = 4096          # No new channel spools beyond this unless an idle one can be dropped
+SPOOL_IDLE_SECONDS = 120       # A spool not written for this long may be dropped to make room
+
 # Configure a session with retry logic
 session = requests.Session()
 retries = Retry(total=5,
@@ -44,7 +89,7 @@ def get_db_connection():
     return conn
 
 def init_db():
-    """Ensures the LiveTV table exists (if not already set up by user)."""
+    """Ensures the LiveTV and ChannelHealth tables exist (if not already set up by user)."""
     conn = get_db_connection()
     try:
         conn.execute("""
@@ -60,6 +105,20 @@ def init_db():
                 "OutputM3UFile"	TEXT 
             );
         """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS "ChannelHealth" (
+                "DLChNo"	INTEGER PRIMARY KEY,
+                "IsAlive"	INTEGER,
+                "ResolveLatencyMs"	INTEGER,
+                "LastChecked"	TEXT,
+                "LastError"	TEXT,
+                "ConsecutiveFailures"	INTEGER NOT NULL DEFAULT 0,
+                "ViewCount"	INTEGER NOT NULL DEFAULT 0
+            );
+        """)
+        health_columns = [row['name'] for row in conn.execute('PRAGMA table_info("ChannelHealth")')]
+        if 'ConsecutiveFailures' not in health_columns:
+            conn.execute('ALTER TABLE "ChannelHealth" ADD COLUMN "ConsecutiveFailures" INTEGER NOT NULL DEFAULT 0')
         conn.commit()
     except Exception as e:
         print(f"DB initialization error: {e}")
@@ -170,17 +229,197 @@ def update_dl_channel_names():
     finally:
         conn.close()
 
+# --- Channel Health Prober ---
+
+# Tunes per channel since the last flush; used to pick channels to pre-warm.
+view_counts = defaultdict(int)
+view_counts_lock = threading.Lock()
+
+class RateLimiter:
+    """Spaces out calls so that at most `rate` start per second across all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            slot = max(time.monotonic(), self.next_slot)
+            self.next_slot = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+probe_limiter = RateLimiter(PROBE_RATE_PER_SECOND)
+
+def record_channel_view(channel_id):
+    """Counts a tune (HLS or TS) towards the channel's popularity."""
+    if str(channel_id).isdigit():
+        with view_counts_lock:
+            view_counts[int(channel_id)] += 1
+
+def flush_channel_views(conn):
+    """Adds the in-memory view counts to ChannelHealth.ViewCount."""
+    with view_counts_lock:
+        pending = dict(view_counts)
+        view_counts.clear()
+    for ch_no, count in pending.items():
+        conn.execute(
+            """INSERT INTO ChannelHealth (DLChNo, ViewCount) VALUES (?, ?)
+               ON CONFLICT(DLChNo) DO UPDATE SET ViewCount = ViewCount + excluded.ViewCount""",
+            (ch_no, count)
+        )
+
+def save_channel_views():
+    """Scheduled (and at-exit) task to persist view counts so restarts don't lose them."""
+    conn = get_db_connection()
+    try:
+        flush_channel_views(conn)
+        conn.commit()
+    except Exception as e:
+        print(f"Saving channel view counts failed: {e}")
+    finally:
+        conn.close()
+
+def probe_channel(ch_no):
+    """
+    Resolves a channel bypassing the cache and checks that its manifest loads.
+    Probes queue behind viewer requests for an admission slot; returns None if
+    the proxy stays too busy to probe.
+    """
+    probe_limiter.wait()
+    if not admission.acquire('prober', AdmissionController.PRIORITY_BACKGROUND, QUEUE_TIMEOUT_SECONDS):
+        return None
+    started = time.monotonic()
+    error = None
+    try:
+        manifest_url, headers = daddylive_api.resolve_stream(str(ch_no), force=True)
+        if not manifest_url:
+            error = "Stream resolution failed"
+        else:
+            r = session.get(manifest_url, headers=headers, timeout=(5, 10))
+            r.raise_for_status()
+            if not r.text.lstrip().startswith('#EXTM3U'):
+                error = "Upstream manifest is not a playlist"
+    except Exception as e:
+        error = str(e)
+    finally:
+        admission.release('prober')
+    latency_ms = int((time.monotonic() - started) * 1000)
+    return ch_no, error is None, latency_ms, error
+
+def probe_all_channels():
+    """
+    Scheduled task to record liveness and resolve latency for mapped channels,
+    skipping PROBE_SKIP_OUTPUT_FILES channels that have never been watched.
+    """
+    print(f"Starting channel health probe at {datetime.now()}")
+    conn = get_db_connection()
+    try:
+        placeholders = ','.join('?' * len(PROBE_SKIP_OUTPUT_FILES)) or "''"
+        channels = [row['DLChNo'] for row in conn.execute(
+            f"""SELECT LiveTV.DLChNo FROM LiveTV
+               LEFT JOIN ChannelHealth ON ChannelHealth.DLChNo = LiveTV.DLChNo
+               WHERE LiveTV.DLChNo IS NOT NULL AND OutputM3UFile IS NOT NULL
+                 AND (OutputM3UFile NOT IN ({placeholders}) OR ChannelHealth.ViewCount > 0)""",
+            PROBE_SKIP_OUTPUT_FILES
+        ).fetchall()]
+    except Exception as e:
+        print(f"Error loading channels for health probe: {e}")
+        return
+    finally:
+        conn.close()
+
+    with ThreadPoolExecutor(max_workers=PROBE_MAX_WORKERS) as pool:
+        results = [r for r in pool.map(probe_channel, channels) if r is not None]
+    if len(results) < len(channels):
+        print(f"Skipped {len(channels) - len(results)} channel probes: proxy busy")
+
+    checked_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN TRANSACTION")
+        for ch_no, alive, latency_ms, error in results:
+            # A single failed probe leaves IsAlive as it was; only DEAD_AFTER_FAILURES
+            # failures in a row mark the channel dead.
+            first_is_alive = 1 if alive else (0 if DEAD_AFTER_FAILURES <= 1 else None)
+            conn.execute(
+                """INSERT INTO ChannelHealth
+                       (DLChNo, IsAlive, ResolveLatencyMs, LastChecked, LastError, ConsecutiveFailures)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(DLChNo) DO UPDATE SET
+                       IsAlive = CASE
+                           WHEN excluded.ConsecutiveFailures = 0 THEN 1
+                           WHEN ConsecutiveFailures + 1 >= ? THEN 0
+                           ELSE IsAlive END,
+                       ResolveLatencyMs = excluded.ResolveLatencyMs,
+                       LastChecked = excluded.LastChecked,
+                       LastError = excluded.LastError,
+                       ConsecutiveFailures = CASE
+                           WHEN excluded.ConsecutiveFailures = 0 THEN 0
+                           ELSE ConsecutiveFailures + 1 END""",
+                (ch_no, first_is_alive, latency_ms, checked_at, error, 0 if alive else 1,
+                 DEAD_AFTER_FAILURES)
+            )
+        conn.commit()
+        alive_count = sum(1 for r in results if r[1])
+        print(f"Channel health probe complete. {alive_count}/{len(results)} channels alive.")
+    except Exception as e:
+        conn.rollback()
+        print(f"Saving channel health failed: {e}")
+    finally:
+        conn.close()
+
+def prewarm_hot_channels():
+    """Resolves the most-watched channels into stream_cache so the first tune is fast."""
+    conn = get_db_connection()
+    try:
+        channels = [row['DLChNo'] for row in conn.execute(
+            """SELECT DLChNo FROM ChannelHealth
+               WHERE ViewCount > 0 AND IFNULL(IsAlive, 1) = 1
+               ORDER BY ViewCount DESC LIMIT ?""",
+            (PREWARM_TOP_CHANNELS,)
+        ).fetchall()]
+    except Exception as e:
+        print(f"Error loading channels to pre-warm: {e}")
+        return
+    finally:
+        conn.close()
+
+    def prewarm(ch_no):
+        probe_limiter.wait()
+        if not admission.acquire('prober', AdmissionController.PRIORITY_BACKGROUND, QUEUE_TIMEOUT_SECONDS):
+            return False
+        try:
+            return daddylive_api.resolve_stream(str(ch_no))[0] is not None
+        finally:
+            admission.release('prober')
+
+    with ThreadPoolExecutor(max_workers=PROBE_MAX_WORKERS) as pool:
+        warmed = sum(pool.map(prewarm, channels))
+    print(f"Pre-warmed {warmed}/{len(channels)} hot channels.")
+
 # --- M3U Generation from DB (Task 3) ---
 
 @app.route('/daddylive/live_tv_m3u/<m3u_filename>')
 def generate_dynamic_m3u(m3u_filename):
     """
     Generates M3U content for a specific file name from the DB.
+    Channels the health prober found dead are shown, flagged or hidden
+    according to ?dead=show|flag|hide (default DEAD_CHANNEL_MODE).
+    Pass ?format=ts to point channels at the continuous MPEG-TS endpoint, and
+    ?max_bitrate=<bits/s> to cap the variant played (default OUTPUT_FILE_MAX_BITRATE).
     """
+    dead_mode = request.args.get('dead', DEAD_CHANNEL_MODE)
+    stream_format = request.args.get('format', 'hls')
+    max_bitrate = request.args.get('max_bitrate', OUTPUT_FILE_MAX_BITRATE.get(m3u_filename, 0), type=int)
     conn = get_db_connection()
     try:
         channels = conn.execute(
-            'SELECT * FROM LiveTV WHERE OutputM3UFile = ? ORDER BY OutputChNo ASC', 
+            """SELECT LiveTV.*, ChannelHealth.IsAlive FROM LiveTV
+               LEFT JOIN ChannelHealth ON ChannelHealth.DLChNo = LiveTV.DLChNo
+               WHERE OutputM3UFile = ? ORDER BY OutputChNo ASC""", 
             (m3u_filename,)
         ).fetchall()
     except Exception as e:
@@ -195,7 +434,18 @@ def generate_dynamic_m3u(m3u_filename):
     m3u_content = [f"#EXTM3U name=\"{m3u_filename.replace('.m3u','')}\""]
     
     for ch in channels:
-        proxy_url = f"{request.url_root.rstrip('/')}/daddylive/hls/{ch['DLChNo']}/{quote('mono.m3u8', safe='')}"
+        is_dead = ch['IsAlive'] == 0
+        if is_dead and dead_mode == 'hide':
+            continue
+
+        if stream_format == 'ts':
+            proxy_url = f"{request.url_root.rstrip('/')}/daddylive/ts/{ch['DLChNo']}"
+            if max_bitrate:
+                proxy_url += f"?max_bitrate={max_bitrate}"
+        else:
+            proxy_url = f"{request.url_root.rstrip('/')}/daddylive/hls/{ch['DLChNo']}/{quote('mono.m3u8', safe='')}"
+            if max_bitrate:
+                proxy_url += f"?max_bitrate={max_bitrate}"
         
         extinf_line = f"""#EXTINF:-1 """
         
@@ -211,7 +461,11 @@ def generate_dynamic_m3u(m3u_filename):
         if ch['GracenoteID']:
              extinf_line += f"""tvc-guide-stationid="{ch['GracenoteID']}" """
         
-        extinf_line += f"""group-title="{ch['OutputChName'] or 'Live TV'}",{ch['OutputChName'] or ch['DLChName']}"""
+        display_name = ch['OutputChName'] or ch['DLChName']
+        if is_dead and dead_mode == 'flag':
+            display_name = f"[OFFLINE] {display_name}"
+
+        extinf_line += f"""group-title="{ch['OutputChName'] or 'Live TV'}",{display_name}"""
         
         m3u_content.append(extinf_line)
         m3u_content.append(proxy_url)
@@ -219,13 +473,325 @@ def generate_dynamic_m3u(m3u_filename):
     return Response("\n".join(m3u_content), mimetype="audio/x-mpegurl")
 
 
+# --- Admission Control ---
+
+class AdmissionController:
+    """
+    Bounds concurrent upstream work globally and per client. Requests that
+    cannot start wait in a bounded queue where already-playing streams are
+    admitted ahead of new tunes, and background work (health probes) goes
+    last. When the queue is full, a request evicts the newest waiter of a
+    lower priority instead of being turned away.
+    """
+    PRIORITY_PLAYING = 0
+    PRIORITY_NEW_TUNE = 1
+    PRIORITY_BACKGROUND = 2
+
+    def __init__(self, max_active, max_per_client, max_queued, active_window):
+        self.max_active = max_active
+        self.max_per_client = max_per_client
+        self.max_queued = max_queued
+        self.active_window = active_window
+        self.cond = threading.Condition()
+        self.active = 0
+        self.active_by_client = defaultdict(int)
+        self.waiting = []       # Tickets: (priority, sequence, client)
+        self.evicted = set()
+        self.sequence = itertools.count()
+        self.last_seen = {}     # (client, channel_id) -> monotonic time of last successful response
+
+    def priority_for(self, client, channel_id):
+        """Classifies a request as part of a playing stream or a new tune."""
+        with self.cond:
+            last = self.last_seen.get((client, channel_id))
+        if last is not None and time.monotonic() - last < self.active_window:
+            return self.PRIORITY_PLAYING
+        return self.PRIORITY_NEW_TUNE
+
+    def mark_playing(self, client, channel_id):
+        """Records a successful response, so the client's next requests count as playing.
+        Rejected or failed requests never get here, so retried tunes stay new tunes."""
+        now = time.monotonic()
+        with self.cond:
+            self.last_seen[(client, channel_id)] = now
+            if len(self.last_seen) > 4096:
+                self.last_seen = {k: t for k, t in self.last_seen.items()
+                                  if now - t < self.active_window}
+
+    def _has_slot(self, client):
+        return (self.active < self.max_active
+                and self.active_by_client[client] < self.max_per_client)
+
+    def _is_next(self, ticket):
+        if not self._has_slot(ticket[2]):
+            return False
+        # Only defer to better-placed waiters that could actually start now.
+        return not any(t < ticket and self._has_slot(t[2]) for t in self.waiting)
+
+    def _start(self, client):
+        self.active += 1
+        self.active_by_client[client] += 1
+
+    def acquire(self, client, priority, timeout):
+        """Waits for a slot; returns False if the queue is full or the wait times out."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            ticket = (priority, next(self.sequence), client)
+            if not self.waiting and self._has_slot(client):
+                self._start(client)
+                return True
+            if len(self.waiting) >= self.max_queued:
+                newest_lower = max((t for t in self.waiting if t[0] > priority), default=None)
+                if newest_lower is None:
+                    return False
+                self.waiting.remove(newest_lower)
+                self.evicted.add(newest_lower)
+                self.cond.notify_all()
+            self.waiting.append(ticket)
+            try:
+                while True:
+                    if ticket in self.evicted:
+                        self.evicted.discard(ticket)
+                        return False
+                    if self._is_next(ticket):
+                        self.waiting.remove(ticket)
+                        self._start(client)
+                        return True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.waiting.remove(ticket)
+                        return False
+                    self.cond.wait(remaining)
+            finally:
+                self.cond.notify_all()
+
+    def release(self, client):
+        with self.cond:
+            self.active -= 1
+            self.active_by_client[client] -= 1
+            if self.active_by_client[client] <= 0:
+                del self.active_by_client[client]
+            self.cond.notify_all()
+
+class TokenBucket:
+    """Byte budget shared by all relays; consume() sleeps while the bucket is in debt."""
+
+    def __init__(self, rate_bytes_per_second, burst_bytes):
+        self.rate = rate_bytes_per_second
+        self.capacity = burst_bytes
+        self.tokens = burst_bytes
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            deficit = -self.tokens
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
+
+admission = AdmissionController(MAX_UPSTREAM_REQUESTS, MAX_CLIENT_REQUESTS,
+                                MAX_QUEUED_REQUESTS, ACTIVE_STREAM_SECONDS)
+bandwidth_budget = TokenBucket(BANDWIDTH_LIMIT_KBPS * 1024, BANDWIDTH_BURST_KB * 1024)
+
+def throttled(chunks):
+    """Yields chunks from an upstream relay, charging each to the shared bandwidth budget."""
+    for chunk in chunks:
+        bandwidth_budget.consume(len(chunk))
+        yield chunk
+
+def overloaded_response():
+    return Response("Proxy is busy, retry shortly.", status=503, mimetype="text/plain",
+                    headers={'Retry-After': str(RETRY_AFTER_SECONDS)})
+
+# --- Playlist Rewriting ---
+
+# Rewritten playlists keyed by (channel, requested resource, proxy base, max bitrate) -> (body, expiry)
+playlist_cache = {}
+playlist_cache_lock = threading.Lock()
+# Variants of each channel's master playlist as last seen; [] when its entry playlist is a media playlist
+channel_variants = {}
+
+def parse_attribute_list(text):
+    """Parses an HLS attribute list such as BANDWIDTH=800000,CODECS="avc1,mp4a"."""
+    return {k: v.strip('"') for k, v in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', text)}
+
+def parse_master_playlist(content, playlist_url):
+    """Returns the variants of a master playlist as dicts with bandwidth, STREAM-INF line and absolute URL."""
+    variants = []
+    pending = None
+    for line in content.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attrs = parse_attribute_list(line.split(':', 1)[1])
+            pending = {'bandwidth': int(attrs.get('BANDWIDTH') or 0), 'info': line}
+        elif line and not line.startswith('#') and pending:
+            pending['url'] = urljoin(playlist_url, line)
+            variants.append(pending)
+            pending = None
+    return variants
+
+def select_variant(variants, max_bitrate):
+    """Highest-bandwidth variant within max_bitrate (the lowest if none fits); highest when uncapped."""
+    if not variants:
+        return None
+    if max_bitrate:
+        fitting = [v for v in variants if v['bandwidth'] <= max_bitrate]
+        if not fitting:
+            return min(variants, key=lambda v: v['bandwidth'])
+        return max(fitting, key=lambda v: v['bandwidth'])
+    return max(variants, key=lambda v: v['bandwidth'])
+
+def remember_variants(channel_id, variants):
+    with playlist_cache_lock:
+        channel_variants[channel_id] = variants
+
+def is_spooled_variant(channel_id, playlist_url, max_bitrate):
+    """
+    True if playlist_url is the variant a (channel, cap) spool follows: the one
+    select_variant picks for the cap. Other variants and rendition (audio,
+    subtitle) playlists are never spooled, so they can't mix into it.
+    """
+    with playlist_cache_lock:
+        variants = channel_variants.get(channel_id)
+    selected = select_variant(variants or [], max_bitrate)
+    return selected is not None and selected['url'] == playlist_url
+
+def variant_cap(channel_id, max_bitrate):
+    """
+    Normalises a bitrate cap to the bandwidth of the variant it selects (0 for the
+    best), so caps that pick the same variant share one TS reader and spool. The
+    cap is returned as given until the channel's master playlist has been seen.
+    """
+    if not max_bitrate:
+        return 0
+    with playlist_cache_lock:
+        variants = channel_variants.get(channel_id)
+    if variants is None:
+        return max_bitrate
+    selected = select_variant(variants, max_bitrate)
+    if selected is None or selected['bandwidth'] == max(v['bandwidth'] for v in variants):
+        return 0
+    return selected['bandwidth']
+
+def proxy_uri_attributes(line, playlist_url, proxy_base):
+    """Points every URI="..." attribute of a tag (keys, maps, renditions) at the proxy."""
+    return re.sub(
+        r'URI="([^"]+)"',
+        lambda m: f'URI="{proxy_base}{quote(urljoin(playlist_url, m.group(1)), safe="")}"',
+        line
+    )
+
+def rewrite_master_playlist(content, playlist_url, proxy_base, max_bitrate):
+    """
+    Rewrites variant URLs through the proxy, keeping only the pinned variant when
+    capped. The cap is carried on the variant URLs so their segments are spooled
+    with the TS reader of the same cap.
+    """
+    pinned = select_variant(parse_master_playlist(content, playlist_url), max_bitrate) if max_bitrate else None
+    cap_query = f'?max_bitrate={max_bitrate}' if max_bitrate else ''
+    rewritten_lines = []
+    skip_uri = False
+    for line in content.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('#EXT-X-STREAM-INF:'):
+            skip_uri = pinned is not None and stripped != pinned['info']
+            if not skip_uri:
+                rewritten_lines.append(line)
+        elif stripped.startswith('#'):
+            rewritten_lines.append(proxy_uri_attributes(line, playlist_url, proxy_base))
+        elif stripped:
+            if not skip_uri:
+                rewritten_lines.append(f'{proxy_base}{quote(urljoin(playlist_url, stripped), safe="")}{cap_query}')
+            skip_uri = False
+        else:
+            rewritten_lines.append(line)
+    return "\n".join(rewritten_lines)
+
+def rewrite_media_playlist(content, playlist_url, proxy_base):
+    """Rewrites segment and key URLs through the proxy; returns (playlist, cache seconds)."""
+    rewritten_lines = []
+    target_duration = 6.0
+    for line in content.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(stripped.split(':', 1)[1])
+        if stripped.startswith('#'):
+            rewritten_lines.append(proxy_uri_attributes(line, playlist_url, proxy_base))
+        elif stripped:
+            rewritten_lines.append(f'{proxy_base}{quote(urljoin(playlist_url, stripped), safe="")}')
+        else:
+            rewritten_lines.append(line)
+    # Half a target duration keeps live playlists fresh while sharing one fetch between pollers.
+    return "\n".join(rewritten_lines), min(max(target_duration / 2, 0.5), 5.0)
+
 # --- HLS Stream Proxy (STABILITY FIX APPLIED) ---
 @app.route('/aes/<channel_id>/<path:proxied_path>')
 @app.route('/daddylive/hls/<channel_id>/<path:proxied_path>')
 def hls_proxy(channel_id, proxied_path):
+    """
+    Serves cached playlists and spooled segments without a slot; anything that
+    needs upstream is admitted first and holds its slot until the upstream
+    response headers arrive. Segment bodies are then paced by bandwidth_budget alone.
+    """
+    client = request.remote_addr or 'unknown'
+    priority = admission.priority_for(client, channel_id)
     original_requested_resource = unquote_plus(proxied_path)
+    response = local_hls_resource(channel_id, original_requested_resource)
+    if response is None:
+        if not admission.acquire(client, priority, QUEUE_TIMEOUT_SECONDS):
+            print(f"[HLS PROXY] Rejecting request for channel {channel_id} from {client}: proxy busy")
+            return overloaded_response()
+        try:
+            response = proxy_hls_resource(channel_id, original_requested_resource)
+        finally:
+            admission.release(client)
+    if response.status_code < 400:
+        if priority == AdmissionController.PRIORITY_NEW_TUNE:
+            record_channel_view(channel_id)
+        admission.mark_playing(client, channel_id)
+    return response
+
+def playlist_cache_key(channel_id, original_requested_resource):
+    """Returns (cache key, proxy base, max bitrate) for a playlist request."""
+    max_bitrate = request.args.get('max_bitrate', DEFAULT_MAX_BITRATE, type=int)
+    channel_path_segment = f'/{channel_id}/'
+    if channel_path_segment in request.path:
+        route_prefix = request.path.split(channel_path_segment, 1)[0]
+        if not route_prefix:
+            route_prefix = '/'
+    else:
+        route_prefix = '/daddylive/hls'
+    if route_prefix != '/' and route_prefix.endswith('/'):
+        route_prefix = route_prefix.rstrip('/')
+    proxy_base = f'{route_prefix}/{channel_id}/'
+    return (channel_id, original_requested_resource, proxy_base, max_bitrate), proxy_base, max_bitrate
+
+def local_hls_resource(channel_id, original_requested_resource):
+    """Answers from the playlist cache or the spool; returns None when upstream is needed."""
+    if urlparse(original_requested_resource).path.endswith('.m3u8'):
+        cache_key = playlist_cache_key(channel_id, original_requested_resource)[0]
+        with playlist_cache_lock:
+            cached = playlist_cache.get(cache_key)
+        if cached and cached[1] > time.monotonic():
+            return Response(cached[0], mimetype='application/x-mpegURL')
+    # Spooled segments don't need upstream, so serve them even while resolution is failing.
+    elif spools and original_requested_resource.startswith(('http://','https://')):
+        spooled = spools.read_segment(channel_id, original_requested_resource)
+        if spooled is not None:
+            print(f"[HLS PROXY] Serving segment of channel {channel_id} from spool")
+            return Response(throttled([spooled]), mimetype='video/mp2t')
+    return None
+
+def proxy_hls_resource(channel_id, original_requested_resource):
     print(f"\n[HLS PROXY] === Processing request for channel {channel_id} ===")
-    
+    proxy_content = urlparse(original_requested_resource).path.endswith('.m3u8')
+
     # Attempt 1: Standard stream resolution
     original_hls_manifest_url, headers_for_upstream = daddylive_api.resolve_stream(channel_id)
 
@@ -234,9 +800,8 @@ def hls_proxy(channel_id, proxied_path):
         print(f"Stream resolution failed for {channel_id}. Attempting API reset...")
         
         try:
-            # 1. Clear the stream cache (assuming cache_lock is available on daddylive_api instance)
-            with daddylive_api.cache_lock:
-                daddylive_api.stream_cache = {}
+            # 1. Forget this channel's cached stream and stages; other channels keep theirs
+            daddylive_api.invalidate(channel_id)
             
             # 2. Force re-initialization of the base URLs (assuming _initialize_base_urls is available)
             daddylive_api._initialize_base_urls()
@@ -256,61 +821,553 @@ def hls_proxy(channel_id, proxied_path):
     # Continue processing the stream...
     parsed_url = urlparse(original_hls_manifest_url)
     upstream_base = f"{parsed_url.scheme}://{parsed_url.netloc}{os.path.dirname(parsed_url.path).rstrip('/')}/"
-    proxy_content = original_requested_resource.endswith('.m3u8')
 
-    if proxy_content:
-        upstream_file_url = original_hls_manifest_url
-    elif original_requested_resource.startswith(('http://','https://')):
+    # Playlists referenced from a rewritten playlist (variants, renditions) arrive as
+    # absolute upstream URLs; only the channel's entry playlist maps to the manifest.
+    if original_requested_resource.startswith(('http://','https://')):
         upstream_file_url = original_requested_resource
+    elif proxy_content:
+        upstream_file_url = original_hls_manifest_url
     else:
         upstream_file_url = urljoin(upstream_base, original_requested_resource)
 
+    if proxy_content:
+        cache_key, proxy_base, max_bitrate = playlist_cache_key(channel_id, original_requested_resource)
+
     try:
         upstream_response = session.get(upstream_file_url, headers=headers_for_upstream, stream=True, timeout=(5,30))
+        if 400 <= upstream_response.status_code < 500 and upstream_file_url == original_hls_manifest_url:
+            # The cached resolve no longer authorises the manifest; resolve afresh once.
+            print(f"[HLS PROXY] Manifest of channel {channel_id} returned {upstream_response.status_code}; re-resolving")
+            upstream_response.close()
+            daddylive_api.invalidate(channel_id)
+            original_hls_manifest_url, headers_for_upstream = daddylive_api.resolve_stream(channel_id)
+            if not original_hls_manifest_url:
+                raise ValueError("Stream re-resolution failed")
+            upstream_file_url = original_hls_manifest_url
+            upstream_response = session.get(upstream_file_url, headers=headers_for_upstream, stream=True, timeout=(5,30))
         upstream_response.raise_for_status()
         mimetype = upstream_response.headers.get('Content-Type','application/octet-stream')
-        if original_requested_resource.endswith('.m3u8'):
+        if proxy_content:
             mimetype = 'application/x-mpegURL'
         elif original_requested_resource.endswith('.ts'):
             mimetype = 'video/mp2t'
 
         if proxy_content:
             content = upstream_response.text
-            rewritten_lines = []
-            channel_path_segment = f'/{channel_id}/'
-            if channel_path_segment in request.path:
-                route_prefix = request.path.split(channel_path_segment, 1)[0]
-                if not route_prefix:
-                    route_prefix = '/'
+            is_entry_playlist = upstream_file_url == original_hls_manifest_url
+            if '#EXT-X-STREAM-INF' in content:
+                if is_entry_playlist:
+                    remember_variants(channel_id, parse_master_playlist(content, upstream_file_url))
+                rewritten, ttl = rewrite_master_playlist(content, upstream_file_url, proxy_base, max_bitrate), MASTER_PLAYLIST_CACHE_SECONDS
             else:
-                route_prefix = '/daddylive/hls'
-            if route_prefix != '/' and route_prefix.endswith('/'):
-                route_prefix = route_prefix.rstrip('/')
-            for line in content.splitlines():
-                stripped = line.strip()
-                if stripped.startswith('#EXT-X-KEY'):
-                    key_match = re.search(r'#EXT-X-KEY:METHOD=(.+?),URI="([^"]+)"', stripped)
-                    if key_match:
-                        method = key_match.group(1)
-                        key_uri = key_match.group(2)
-                        resolved_key = urljoin(upstream_file_url, key_uri)
-                        proxied_key = f'{route_prefix}/{channel_id}/{quote(resolved_key,safe="")}'
-                        rewritten_lines.append(f'#EXT-X-KEY:METHOD={method},URI="{proxied_key}"')
-                        continue
-                if stripped and not stripped.startswith('#'):
-                    resolved_media = urljoin(upstream_file_url, stripped)
-                    proxied_media = f'{route_prefix}/{channel_id}/{quote(resolved_media,safe="")}'
-                    rewritten_lines.append(proxied_media)
-                else:
-                    rewritten_lines.append(line)
-            return Response("\n".join(rewritten_lines), mimetype=mimetype)
+                rewritten, ttl = rewrite_media_playlist(content, upstream_file_url, proxy_base)
+                if is_entry_playlist:
+                    remember_variants(channel_id, [])
+                spool = None
+                if spools and (is_entry_playlist or is_spooled_variant(channel_id, upstream_file_url, max_bitrate)):
+                    spool = spools.get((channel_id, variant_cap(channel_id, max_bitrate)), create=True)
+                if spool:
+                    # Lets the segment relay below tee what it sends into the spool.
+                    spool.expect(parse_media_playlist(content, upstream_file_url)[1])
+            with playlist_cache_lock:
+                now = time.monotonic()
+                if len(playlist_cache) > 256:
+                    for stale_key in [k for k, (_, expires) in playlist_cache.items() if expires <= now]:
+                        del playlist_cache[stale_key]
+                playlist_cache[cache_key] = (rewritten, now + ttl)
+            return Response(rewritten, mimetype=mimetype)
         else:
-            return Response(stream_with_context(upstream_response.iter_content(chunk_size=8192)), mimetype=mimetype)
+            chunks = upstream_response.iter_content(chunk_size=8192)
+            spool, segment = spools.find_expected(channel_id, upstream_file_url) if spools else (None, None)
+            if segment:
+                chunks = spool_tee(chunks, spool, segment)
+            return Response(stream_with_context(throttled(chunks)), mimetype=mimetype)
     except Exception as e:
         import traceback
         traceback.print_exc()
         abort(500, description=str(e))
 
+# --- Continuous MPEG-TS Relay ---
+
+def parse_media_playlist(content, playlist_url):
+    """
+    Parses an HLS media playlist into (target_duration, segments). Each segment is a
+    dict with its media sequence number, absolute URL, duration and the EXT-X-KEY
+    attributes in effect for it (None when unencrypted).
+    """
+    target_duration = 6.0
+    sequence = 0
+    duration = 0.0
+    key = None
+    segments = []
+    for line in content.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-TARGETDURATION:'):
+            target_duration = float(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line.split(':', 1)[1].split(',', 1)[0])
+        elif line.startswith('#EXT-X-KEY:'):
+            attrs = parse_attribute_list(line.split(':', 1)[1])
+            if attrs.get('METHOD', 'NONE') == 'NONE':
+                key = None
+            else:
+                key = {'method': attrs['METHOD'], 'uri': urljoin(playlist_url, attrs.get('URI', '')),
+                       'iv': attrs.get('IV')}
+        elif line and not line.startswith('#'):
+            segments.append({'sequence': sequence, 'url': urljoin(playlist_url, line),
+                             'duration': duration, 'key': key})
+            sequence += 1
+            duration = 0.0
+    return target_duration, segments
+
+def decrypt_segment(data, key_bytes, iv, sequence):
+    """AES-128-CBC decrypts a segment; without an explicit IV the media sequence is used."""
+    if iv:
+        iv_bytes = bytes.fromhex(iv[2:] if iv.lower().startswith('0x') else iv).rjust(16, b'\0')
+    else:
+        iv_bytes = sequence.to_bytes(16, 'big')
+    decryptor = Cipher(algorithms.AES(key_bytes), modes.CBC(iv_bytes)).decryptor()
+    plain = decryptor.update(data) + decryptor.finalize()
+    if plain and 0 < plain[-1] <= 16:
+        plain = plain[:-plain[-1]]
+    return plain
+
+ts_readers = {}    # (channel_id, variant_cap) -> ChannelTSReader
+ts_readers_lock = threading.Lock()
+
+class ChannelTSReader:
+    """
+    Follows one channel's upstream playlist, at the variant its bitrate cap
+    selects, on a background thread and fans the segments out, in order, to
+    every viewer of /daddylive/ts/<channel_id> with that cap.
+    """
+
+    def __init__(self, channel_id, max_bitrate):
+        self.channel_id = channel_id
+        self.max_bitrate = max_bitrate
+        self.client = f"ts-reader:{channel_id}:{max_bitrate}"
+        self.viewers = set()
+        self.last_segment = None    # (segment, raw data, upstream headers) of the newest segment
+        self.stopped = False
+        self.idle_since = time.monotonic()
+        self.keys = OrderedDict()   # Key URI -> key bytes, least recently used first
+        self.keys_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name=f"ts-reader-{channel_id}", daemon=True)
+
+    def subscribe(self):
+        """
+        Registers a viewer queue that starts with the newest segment so playback
+        begins at once. That segment is only decrypted here, when a viewer joins.
+        Returns None if the reader has stopped. Call without ts_readers_lock held.
+        """
+        viewer = queue.Queue(maxsize=TS_VIEWER_BUFFER_SEGMENTS)
+        while True:
+            with ts_readers_lock:
+                newest = self.last_segment
+            first = None
+            if newest:
+                try:
+                    first = self.decrypt(*newest)
+                except Exception as e:
+                    print(f"[TS RELAY] Channel {self.channel_id} could not decrypt start segment: {e}")
+            with ts_readers_lock:
+                if self.stopped:
+                    return None
+                # Retry if a newer segment was published while we decrypted.
+                if self.last_segment is newest:
+                    if first:
+                        viewer.put_nowait(first)
+                    self.viewers.add(viewer)
+                    return viewer
+
+    def unsubscribe(self, viewer):
+        with ts_readers_lock:
+            self.viewers.discard(viewer)
+            if not self.viewers:
+                self.idle_since = time.monotonic()
+
+    def publish(self, segment, data, headers):
+        with ts_readers_lock:
+            self.last_segment = (segment, data, headers)
+            viewers = list(self.viewers)
+        if not viewers:
+            return
+        data = self.decrypt(segment, data, headers)
+        for viewer in viewers:
+            while True:
+                try:
+                    viewer.put_nowait(data)
+                    break
+                except queue.Full:
+                    # Slow viewer: skip its oldest segment rather than stall the others.
+                    try:
+                        viewer.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def touch(self):
+        """Keeps the reader running without a viewer (e.g. to feed the spool)."""
+        self.idle_since = max(self.idle_since, time.monotonic())
+
+    def is_idle(self):
+        return not self.viewers and time.monotonic() - self.idle_since > TS_IDLE_SECONDS
+
+    def fetch(self, url, headers, priority):
+        if not admission.acquire(self.client, priority, QUEUE_TIMEOUT_SECONDS):
+            raise RuntimeError("Proxy busy")
+        try:
+            response = session.get(url, headers=headers, timeout=(5, 30))
+            response.raise_for_status()
+            return response
+        finally:
+            admission.release(self.client)
+
+    def decrypt(self, segment, data, headers):
+        key = segment['key']
+        if key is None:
+            return data
+        if key['method'] != 'AES-128':
+            raise ValueError(f"Unsupported encryption method {key['method']}")
+        with self.keys_lock:
+            key_bytes = self.keys.get(key['uri'])
+            if key_bytes is not None:
+                self.keys.move_to_end(key['uri'])
+        if key_bytes is None:
+            key_bytes = self.fetch(key['uri'], headers, AdmissionController.PRIORITY_PLAYING).content
+            with self.keys_lock:
+                self.keys[key['uri']] = key_bytes
+                # Keys rotate over a live stream; only the last few can still be in a playlist.
+                while len(self.keys) > 4:
+                    self.keys.popitem(last=False)
+        return decrypt_segment(data, key_bytes, key['iv'], segment['sequence'])
+
+    def run(self):
+        print(f"[TS RELAY] Starting reader for channel {self.channel_id}")
+        last_sequence = None
+        failures = 0
+        while True:
+            with ts_readers_lock:
+                if self.is_idle():
+                    del ts_readers[(self.channel_id, self.max_bitrate)]
+                    self.stopped = True
+                    break
+            try:
+                playlist_url, headers = daddylive_api.resolve_stream(self.channel_id, force=failures >= 2)
+                if not playlist_url:
+                    raise ValueError("Stream resolution failed")
+                priority = (AdmissionController.PRIORITY_NEW_TUNE if last_sequence is None
+                            else AdmissionController.PRIORITY_PLAYING)
+                playlist = self.fetch(playlist_url, headers, priority)
+                if '#EXT-X-STREAM-INF' in playlist.text:
+                    variants = parse_master_playlist(playlist.text, playlist.url)
+                    remember_variants(self.channel_id, variants)
+                    variant = select_variant(variants, self.max_bitrate)
+                    if variant is None:
+                        raise ValueError("Upstream master playlist has no variants")
+                    playlist = self.fetch(variant['url'], headers, priority)
+                else:
+                    remember_variants(self.channel_id, [])
+                target_duration, segments = parse_media_playlist(playlist.text, playlist.url)
+                if not segments:
+                    raise ValueError("Upstream playlist has no segments")
+                if last_sequence is not None and segments[-1]['sequence'] < last_sequence - len(segments):
+                    print(f"[TS RELAY] Channel {self.channel_id} media sequence restarted")
+                    last_sequence = None
+                if last_sequence is None:
+                    # Join at the live edge instead of replaying the whole window.
+                    segments = segments[-1:]
+                for segment in segments:
+                    if last_sequence is not None and segment['sequence'] <= last_sequence:
+                        continue
+                    spool = spools.get((self.channel_id, self.max_bitrate), create=True) if spools else None
+                    # HLS clients of the channel may already have teed this segment into the spool.
+                    data = spool.read_segment(segment['url']) if spool else None
+                    if data is None:
+                        data = self.fetch(segment['url'], headers, AdmissionController.PRIORITY_PLAYING).content
+                        if spool:
+                            spool.append(segment, data)
+                    self.publish(segment, data, headers)
+                    last_sequence = segment['sequence']
+                failures = 0
+                time.sleep(max(1.0, target_duration / 2))
+            except Exception as e:
+                failures += 1
+                print(f"[TS RELAY] Channel {self.channel_id} read failed ({failures}): {e}")
+                # Don't start viewers that join while we're failing on stale video.
+                with ts_readers_lock:
+                    self.last_segment = None
+                time.sleep(min(RETRY_AFTER_SECONDS * failures, 30))
+        print(f"[TS RELAY] Stopped reader for channel {self.channel_id}")
+
+def get_ts_reader(channel_id, max_bitrate):
+    """Returns the running reader for the channel and cap, starting one if needed. Call with ts_readers_lock held."""
+    max_bitrate = variant_cap(channel_id, max_bitrate)
+    reader = ts_readers.get((channel_id, max_bitrate))
+    if reader is None:
+        reader = ts_readers[(channel_id, max_bitrate)] = ChannelTSReader(channel_id, max_bitrate)
+        reader.thread.start()
+    return reader
+
+def keep_ts_reader_alive(channel_id, max_bitrate):
+    with ts_readers_lock:
+        get_ts_reader(channel_id, max_bitrate).touch()
+
+@app.route('/daddylive/ts/<channel_id>')
+def ts_stream(channel_id):
+    """
+    One long-lived MPEG-TS stream per viewer, fed by a single shared upstream reader.
+    Tuning in is admitted like a new HLS tune; the slot is released once subscribed.
+    """
+    max_bitrate = request.args.get('max_bitrate', DEFAULT_MAX_BITRATE, type=int)
+    client = request.remote_addr or 'unknown'
+    new_tune = admission.priority_for(client, channel_id) == AdmissionController.PRIORITY_NEW_TUNE
+    if not admission.acquire(client, AdmissionController.PRIORITY_NEW_TUNE, QUEUE_TIMEOUT_SECONDS):
+        print(f"[TS RELAY] Rejecting tune to channel {channel_id} from {client}: proxy busy")
+        return overloaded_response()
+    try:
+        viewer = None
+        while viewer is None:
+            with ts_readers_lock:
+                reader = get_ts_reader(channel_id, max_bitrate)
+            viewer = reader.subscribe()
+    finally:
+        admission.release(client)
+    if new_tune:
+        record_channel_view(channel_id)
+    admission.mark_playing(client, channel_id)
+
+    def generate():
+        try:
+            while True:
+                try:
+                    data = viewer.get(timeout=TS_STALL_SECONDS)
+                except queue.Empty:
+                    print(f"[TS RELAY] Channel {channel_id} stalled; closing viewer stream")
+                    break
+                bandwidth_budget.consume(len(data))
+                yield data
+        finally:
+            reader.unsubscribe(viewer)
+
+    return Response(stream_with_context(generate()), mimetype='video/mp2t')
+
+# --- Disk Segment Spool ---
+
+class SegmentSpool:
+    """
+    Fixed-size ring buffer file holding one channel's most recent raw (still
+    encrypted) upstream segments. Segments are appended at the write offset,
+    wrapping to the start of the file, and read back through a memory map.
+    Segments are fed by the bytes hls_proxy already relays (announced through
+    expect() when it rewrites the spooled variant's media playlist) and by the
+    channel's TS reader.
+    """
+
+    def __init__(self, path, capacity, window_seconds):
+        self.path = path
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # media sequence -> segment entry, oldest first
+        self.by_url = {}
+        self.expected = OrderedDict()   # Segment URL -> playlist metadata, for relayed segments
+        self.write_offset = 0
+        self.last_write = time.monotonic()
+        self.file = open(path, 'w+b')
+        self.file.truncate(capacity)
+        self.map = mmap.mmap(self.file.fileno(), capacity)
+
+    def _drop_oldest(self):
+        _, entry = self.entries.popitem(last=False)
+        self.by_url.pop(entry['url'], None)
+
+    def append(self, segment, data):
+        size = len(data)
+        if size > self.capacity:
+            return
+        with self.lock:
+            # Keep entries in sequence order; late or duplicate segments are skipped.
+            if self.map is None or (self.entries and segment['sequence'] <= next(reversed(self.entries))):
+                return
+            if self.write_offset + size > self.capacity:
+                self.write_offset = 0
+            start, end = self.write_offset, self.write_offset + size
+            # Drop segments the new one overwrites, then anything outside the time window.
+            for entry in list(self.entries.values()):
+                if entry['offset'] < end and start < entry['offset'] + entry['length']:
+                    del self.entries[entry['sequence']]
+                    self.by_url.pop(entry['url'], None)
+            while self.entries and (sum(e['duration'] for e in self.entries.values())
+                                    + segment['duration'] > self.window_seconds):
+                self._drop_oldest()
+            self.map[start:end] = data
+            self.entries[segment['sequence']] = {
+                'sequence': segment['sequence'], 'url': segment['url'], 'duration': segment['duration'],
+                'key': segment['key'], 'offset': start, 'length': size
+            }
+            self.by_url[segment['url']] = segment['sequence']
+            self.expected.pop(segment['url'], None)
+            self.write_offset = end
+            self.last_write = time.monotonic()
+
+    def expect(self, segments):
+        """Remembers the metadata of segments listed in a playlist hls_proxy just served."""
+        with self.lock:
+            for segment in segments:
+                if segment['url'] not in self.by_url:
+                    self.expected[segment['url']] = segment
+                    self.expected.move_to_end(segment['url'])
+            while len(self.expected) > 64:
+                self.expected.popitem(last=False)
+
+    def expected_segment(self, url):
+        with self.lock:
+            return self.expected.get(url)
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.entries.values())
+
+    def read_segment(self, url=None, sequence=None):
+        """Copies a segment out of the mapped file under the lock; None if it isn't spooled (any more)."""
+        with self.lock:
+            if sequence is None:
+                sequence = self.by_url.get(url)
+            entry = self.entries.get(sequence)
+            if self.map is None or entry is None:
+                return None
+            return self.map[entry['offset']:entry['offset'] + entry['length']]
+
+    def close(self):
+        with self.lock:
+            self.map.close()
+            self.map = None
+            self.entries.clear()
+            self.by_url.clear()
+            self.expected.clear()
+        self.file.close()
+        os.remove(self.path)
+
+class SpoolManager:
+    """
+    Owns the per-channel spools and enforces the global size limit. When it is
+    reached, the least recently used idle spool is dropped to make room; spools
+    still being written are never dropped, so the new spool is refused instead.
+    """
+
+    def __init__(self, directory, channel_bytes, total_bytes, window_seconds):
+        self.directory = directory
+        self.channel_bytes = channel_bytes
+        self.max_channels = max(1, total_bytes // channel_bytes)
+        self.window_seconds = window_seconds
+        self.lock = threading.Lock()
+        self.spools = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        # Spool indexes live in memory, so files left by a previous run are unusable.
+        for name in os.listdir(directory):
+            if name.endswith('.spool'):
+                os.remove(os.path.join(directory, name))
+
+    def get(self, spool_key, create=False):
+        """Returns the spool for a (channel_id, variant_cap) key, optionally creating it."""
+        with self.lock:
+            spool = self.spools.get(spool_key)
+            if spool is not None:
+                self.spools.move_to_end(spool_key)
+                return spool
+            if not create:
+                return None
+            if len(self.spools) >= self.max_channels:
+                now = time.monotonic()
+                idle_id = next((spool_id for spool_id, s in self.spools.items()
+                                if now - s.last_write > SPOOL_IDLE_SECONDS), None)
+                if idle_id is None:
+                    return None
+                print(f"[SPOOL] Dropping idle spool {idle_id} to make room for {spool_key}")
+                self.spools.pop(idle_id).close()
+            channel_id, max_bitrate = spool_key
+            safe_id = re.sub(r'[^A-Za-z0-9_-]', '_', channel_id)
+            spool = self.spools[spool_key] = SegmentSpool(
+                os.path.join(self.directory, f"{safe_id}_{max_bitrate}.spool"), self.channel_bytes, self.window_seconds)
+            return spool
+
+    def channel_spools(self, channel_id):
+        with self.lock:
+            return [spool for (spool_channel, _), spool in self.spools.items() if spool_channel == channel_id]
+
+    def read_segment(self, channel_id, url):
+        """Segment URLs are unique to a variant, so any of the channel's spools may hold it."""
+        for spool in self.channel_spools(channel_id):
+            data = spool.read_segment(url)
+            if data is not None:
+                return data
+        return None
+
+    def find_expected(self, channel_id, url):
+        """Returns (spool, segment metadata) for a relayed segment some spool is waiting for."""
+        for spool in self.channel_spools(channel_id):
+            segment = spool.expected_segment(url)
+            if segment:
+                return spool, segment
+        return None, None
+
+def spool_tee(chunks, spool, segment):
+    """Relays upstream chunks unchanged; the segment is spooled only if it arrived whole."""
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    spool.append(segment, b''.join(parts))
+
+spools = None
+if SPOOL_DIR:
+    spools = SpoolManager(SPOOL_DIR, SPOOL_CHANNEL_MB * 1024 * 1024,
+                          SPOOL_TOTAL_MB * 1024 * 1024, SPOOL_WINDOW_MINUTES * 60)
+
+@app.route('/daddylive/dvr/<channel_id>/index.m3u8')
+def dvr_playlist(channel_id):
+    """Playlist covering every spooled segment of the channel, for time-shifting clients."""
+    if not spools:
+        abort(404, "Segment spool is disabled.")
+    max_bitrate = request.args.get('max_bitrate', DEFAULT_MAX_BITRATE, type=int)
+    cap_query = f'?max_bitrate={max_bitrate}' if max_bitrate else ''
+    keep_ts_reader_alive(channel_id, max_bitrate)
+    spool = spools.get((channel_id, variant_cap(channel_id, max_bitrate)))
+    entries = spool.snapshot() if spool else []
+    if not entries:
+        return Response("Channel is still buffering, retry shortly.", status=503, mimetype="text/plain",
+                        headers={'Retry-After': str(RETRY_AFTER_SECONDS)})
+
+    target_duration = math.ceil(max(e['duration'] for e in entries))
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{target_duration}',
+             f'#EXT-X-MEDIA-SEQUENCE:{entries[0]["sequence"]}']
+    previous = None
+    for entry in entries:
+        if previous is not None and entry['sequence'] != previous + 1:
+            lines.append('#EXT-X-DISCONTINUITY')
+        key = entry['key']
+        if key:
+            # Always give the IV explicitly: gaps would shift an implicit, sequence-based IV.
+            iv = key['iv'] or f"0x{entry['sequence']:032x}"
+            proxied_key = f"/daddylive/hls/{channel_id}/{quote(key['uri'], safe='')}"
+            lines.append(f'#EXT-X-KEY:METHOD={key["method"]},URI="{proxied_key}",IV={iv}')
+        lines.append(f'#EXTINF:{entry["duration"]:.3f},')
+        lines.append(f'/daddylive/dvr/{channel_id}/{entry["sequence"]}.ts{cap_query}')
+        previous = entry['sequence']
+    return Response("\n".join(lines), mimetype='application/x-mpegURL')
+
+@app.route('/daddylive/dvr/<channel_id>/<int:sequence>.ts')
+def dvr_segment(channel_id, sequence):
+    max_bitrate = request.args.get('max_bitrate', DEFAULT_MAX_BITRATE, type=int)
+    spool = spools.get((channel_id, variant_cap(channel_id, max_bitrate))) if spools else None
+    data = spool.read_segment(sequence=sequence) if spool else None
+    if data is None:
+        abort(404, "Segment is no longer spooled.")
+    return Response(throttled([data]), mimetype='video/mp2t')
+
 # --- Events M3U (UNCHANGED) ---
 @app.route('/daddylive/events.m3u')
 def generate_events_m3u():
@@ -470,8 +1527,33 @@ scheduler.add_job(
     name='Update DL Channel Names',
     max_instances=1
 )
+scheduler.add_job(
+    func=probe_all_channels,
+    trigger='interval',
+    minutes=PROBE_INTERVAL_MINUTES,
+    id='channel_health_prober',
+    name='Probe Channel Health',
+    max_instances=1,
+    next_run_time=datetime.now()
+)
+scheduler.add_job(
+    func=save_channel_views,
+    trigger='interval',
+    minutes=VIEW_FLUSH_MINUTES,
+    id='channel_view_saver',
+    name='Save Channel View Counts',
+    max_instances=1
+)
+atexit.register(save_channel_views)
+scheduler.add_job(
+    func=prewarm_hot_channels,
+    trigger='date',
+    id='hot_channel_prewarm',
+    name='Pre-warm Hot Channels'
+)
 scheduler.start()
 print(f"Scheduler started: DL Channel names will update every {UPDATE_INTERVAL_HOURS} hours.")
+print(f"Channel health will be probed every {PROBE_INTERVAL_MINUTES} minutes.")
 
 
 if __name__=='__main__':
@@ -7,6 +7,7 @@ from urllib.parse import urlparse, quote_plus, unquote
 from datetime import datetime, timedelta, timezone
 import threading
 import base64
+import time
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
@@ -30,6 +31,12 @@ class DaddyLiveAPI:
         self.cache_expiry_minutes = 7
         self.cache_lock = threading.Lock()
 
+        # Intermediate resolve results per channel (player/iframe URL, channel key,
+        # host, server lookup path, signed auth bundle), so a refresh can skip
+        # straight to the auth and server lookup hops.
+        self.stage_cache = {}
+        self.stage_cache_expiry_minutes = 120
+
     def _initialize_base_urls(self):
         try:
             main_url_content = self.session.get('https://raw.githubusercontent.com/thecrewwh/dl_url/refs/heads/main/dl.xml', timeout=5).text
@@ -123,12 +130,12 @@ class DaddyLiveAPI:
             print(f"Error fetching scheduled events: {e}")
         return all_events
 
-    def resolve_stream(self, channel_id):
+    def resolve_stream(self, channel_id, force=False):
         print(f"\n[DEBUG] === Resolving stream for channel {channel_id} ===")
         
         with self.cache_lock:
             cached = self.stream_cache.get(channel_id)
-            if cached:
+            if cached and not force:
                 url, headers, timestamp = cached
                 if datetime.now() - timestamp < timedelta(minutes=self.cache_expiry_minutes):
                     print(f"[DEBUG] Using cached stream for channel {channel_id}")
@@ -138,6 +145,232 @@ class DaddyLiveAPI:
         if not self.baseurl:
             self._initialize_base_urls()
 
+        with self.cache_lock:
+            stages = self.stage_cache.get(channel_id)
+            if stages and time.time() - stages['resolved_at'] >= self.stage_cache_expiry_minutes * 60:
+                del self.stage_cache[channel_id]
+                stages = None
+
+        if stages:
+            final_hls_url, hls_headers = self._resolve_from_stages(channel_id, stages)
+            if final_hls_url:
+                return final_hls_url, hls_headers
+            print(f"[DEBUG] Cached stages failed validation for channel {channel_id}, doing full resolve")
+            with self.cache_lock:
+                self.stage_cache.pop(channel_id, None)
+
+        return self._full_resolve(channel_id)
+
+    def invalidate(self, channel_id):
+        """Forgets a channel's resolved stream and cached stages."""
+        with self.cache_lock:
+            self.stream_cache.pop(channel_id, None)
+            self.stage_cache.pop(channel_id, None)
+
+    def _parse_player_page(self, response):
+        """Extracts channel key, signed auth bundle, host and server lookup path from the iframe page."""
+        # Extract channel_key (NOT base64 encoded)
+        channel_key_match = re.search(r'const\s+CHANNEL_KEY\s*=\s*"([^"]+)"', response)
+        if not channel_key_match:
+            channel_key_match = re.search(r'channelKey\s*=\s*["\']([^"\']+)["\']', response)
+            if not channel_key_match:
+                print("[ERROR] Step 3: Could not find CHANNEL_KEY. Checking for other variable names...")
+                # Look for ANY const declarations for debugging
+                all_consts = re.findall(r'const\s+(\w+)\s*=', response)
+                print(f"[DEBUG] All const variables found: {all_consts[:20]}")
+                return None
+        channel_key = channel_key_match.group(1)
+        print(f"[DEBUG] Step 3: Found CHANNEL_KEY: {channel_key}")
+
+        # Extract the bundled parameters (XKZK bundle - base64 encoded JSON)
+        bundle_match = re.search(r'const\s+XKZK\s*=\s*"([^"]+)"', response)
+        if not bundle_match:
+            bundle_match = re.search(r'const\s+XJZ\s*=\s*"([^"]+)"', response)
+            if not bundle_match:
+                print("[ERROR] Step 3: Could not find XKZK or XJZ bundle")
+                return None
+        
+        bundle = bundle_match.group(1)
+        print(f"[DEBUG] Step 3: Found bundle (first 50 chars): {bundle[:50]}...")
+        
+        parts = json.loads(base64.b64decode(bundle).decode("utf-8"))
+        print(f"[DEBUG] Step 3: Decoded bundle keys: {list(parts.keys())}")
+        
+        # Now decode each part from base64
+        for k, v in parts.items():
+            parts[k] = base64.b64decode(v).decode("utf-8")
+
+        # Extract host array
+        host_array_match = re.search(r"host\s*=\s*\[([^\]]+)\]", response)
+        if not host_array_match:
+            print("[ERROR] Step 3: Could not find host array")
+            return None
+        
+        host_parts = [part.strip().strip("'\"") for part in host_array_match.group(1).split(',')]
+        host = ''.join(host_parts)
+        print(f"[DEBUG] Step 3: Found host: {host}")
+
+        # Get server lookup URL
+        server_lookup_match = re.findall(r'fetchWithRetry\(\s*["\']([^"\']*)', response)
+        if not server_lookup_match:
+            print("[ERROR] Step 3: Could not find server lookup URL")
+            return None
+        server_lookup = server_lookup_match[0]
+        print(f"[DEBUG] Step 3: Found server lookup: {server_lookup}")
+
+        return {
+            'channel_key': channel_key,
+            'host': host,
+            'server_lookup': server_lookup,
+            'auth_params': parts
+        }
+
+    def _fetch_player_page(self, url3):
+        headers = self.get_headers(
+            referer_override=url3,
+            origin_override=urlparse(url3).scheme + "://" + urlparse(url3).netloc
+        )
+        print(f"[DEBUG] Step 3: Fetching {url3}")
+        response = requests.get(url3, headers=headers, timeout=10, verify=False).text
+        print(f"[DEBUG] Step 3 response length: {len(response)} chars")
+        return response, headers
+
+    def _authenticate(self, channel_id, stages, headers, validate=False):
+        """
+        Runs the signed auth and server lookup hops, caching the final HLS URL on success.
+        With validate (for a reused auth bundle) the auth must succeed and the manifest
+        must load before the URL is cached.
+        """
+        channel_key = stages['channel_key']
+        parts = stages['auth_params']
+        url3 = stages['iframe_url']
+
+        # Construct the authentication script path by XORing bytes
+        bx = [40, 60, 61, 33, 103, 57, 33, 57]
+        sc = ''.join(chr(b ^ 73) for b in bx)
+
+        # Build authentication URL
+        auth_url = (
+            f'{stages["host"]}{sc}?channel_id={quote_plus(channel_key)}&'
+            f'ts={quote_plus(parts["b_ts"])}&'
+            f'rnd={quote_plus(parts["b_rnd"])}&'
+            f'sig={quote_plus(parts["b_sig"])}'
+        )
+        print(f"[DEBUG] Step 4: Calling auth URL: {auth_url[:80]}...")
+
+        # Call authentication endpoint
+        auth_response = requests.get(auth_url, headers=headers, timeout=10, verify=False)
+        print(f"[DEBUG] Step 4: Auth response status: {auth_response.status_code}")
+        if validate and not auth_response.ok:
+            print("[ERROR] Step 4: Auth rejected the cached parameters")
+            return None, None
+
+        # Get server key
+        server_lookup_url = f"https://{urlparse(url3).netloc}{stages['server_lookup']}{channel_key}"
+        print(f"[DEBUG] Step 5: Calling server lookup: {server_lookup_url}")
+        
+        server_response = requests.get(server_lookup_url, headers=headers, timeout=10, verify=False).json()
+        server_key = server_response.get('server_key')
+        print(f"[DEBUG] Step 5: Server response: {server_response}")
+
+        if not server_key:
+            print("[ERROR] Step 5: Could not get server_key from server lookup")
+            return None, None
+
+        # Construct final HLS URL based on server_key
+        host_raw = f"https://{urlparse(url3).netloc}"
+        if server_key == "top1/cdn":
+            final_hls_url = f"https://top1.newkso.ru/top1/cdn/{channel_key}/mono.m3u8"
+        else:
+            final_hls_url = f"https://{server_key}new.newkso.ru/{server_key}/{channel_key}/mono.m3u8"
+
+        print(f"[DEBUG] Step 6: Final HLS URL: {final_hls_url}")
+
+        hls_headers = {
+            'Referer': f"{host_raw}/",
+            'Origin': host_raw,
+            'User-Agent': self.UA,
+            'Connection': 'keep-alive'
+        }
+
+        if validate:
+            manifest = requests.get(final_hls_url, headers=hls_headers, timeout=10, verify=False)
+            if not manifest.ok or not manifest.text.lstrip().startswith('#EXTM3U'):
+                print(f"[ERROR] Step 6: Manifest did not load with the cached parameters ({manifest.status_code})")
+                return None, None
+
+        with self.cache_lock:
+            self.stream_cache[channel_id] = (final_hls_url, hls_headers, datetime.now())
+
+        print(f"[DEBUG] === Successfully resolved stream for channel {channel_id} ===\n")
+        return final_hls_url, hls_headers
+
+    def _resolve_from_stages(self, channel_id, stages):
+        """
+        Refreshes a channel from its cached stages, going back one stage at a time:
+        the cached signed auth bundle is tried first, then a bundle from a re-fetched
+        iframe page, then the iframe found on a re-fetched player (cast) page.
+        """
+        print(f"[DEBUG] Refreshing channel {channel_id} from cached stages")
+        try:
+            url3 = stages['iframe_url']
+            headers = self.get_headers(
+                referer_override=url3,
+                origin_override=urlparse(url3).scheme + "://" + urlparse(url3).netloc
+            )
+            final_hls_url, hls_headers = self._authenticate(channel_id, stages, headers, validate=True)
+            if final_hls_url:
+                return final_hls_url, hls_headers
+
+            print(f"[DEBUG] Cached auth bundle rejected for channel {channel_id}, re-fetching iframe page")
+            response, headers = self._fetch_player_page(url3)
+            page = self._parse_player_page(response)
+            if page and page['channel_key'] == stages['channel_key']:
+                with self.cache_lock:
+                    stages.update(page)
+                final_hls_url, hls_headers = self._authenticate(channel_id, stages, headers, validate=True)
+                if final_hls_url:
+                    return final_hls_url, hls_headers
+
+            print(f"[DEBUG] Iframe page is stale for channel {channel_id}, re-fetching player page")
+            return self._resolve_from_player_url(channel_id, stages['player_url'], self.get_headers())
+        except Exception as e:
+            print(f"[ERROR] Exception refreshing from cached stages: {e}")
+            return None, None
+
+    def _resolve_from_player_url(self, channel_id, url2, headers):
+        """Steps 2 onwards: finds the iframe on the player page, authenticates and caches the stages."""
+        print(f"[DEBUG] Step 2: Fetching {url2}")
+
+        headers['Referer'] = url2
+        headers['Origin'] = urlparse(url2).scheme + "://" + urlparse(url2).netloc
+        response = requests.get(url2, headers=headers, timeout=10, verify=False).text
+        print(f"[DEBUG] Step 2 response length: {len(response)} chars")
+
+        iframes = re.findall(r'iframe\s+src="([^"]*)', response, re.IGNORECASE)
+        if not iframes:
+            print("[ERROR] Step 2: No iframe src found.")
+            return None, None
+
+        url3 = iframes[0]
+        print(f"[DEBUG] Step 2: Found iframe: {url3}")
+        
+        if not url3.startswith('http'):
+            url3 = f"https://{urlparse(headers['Referer']).netloc}{url3}"
+
+        response, headers = self._fetch_player_page(url3)
+        page = self._parse_player_page(response)
+        if not page:
+            return None, None
+
+        stages = dict(page, player_url=url2, iframe_url=url3, resolved_at=time.time())
+        final_hls_url, hls_headers = self._authenticate(channel_id, stages, headers)
+        if final_hls_url:
+            with self.cache_lock:
+                self.stage_cache[channel_id] = stages
+        return final_hls_url, hls_headers
+
+    def _full_resolve(self, channel_id):
         url_stream = self.json_url % channel_id
         headers = self.get_headers()
         print(f"[DEBUG] Step 1: Fetching {url_stream}")
@@ -173,129 +406,7 @@ class DaddyLiveAPI:
             if not url2.startswith('http'):
                 url2 = self.baseurl + url2
             url2 = url2.replace('//cast','/cast')
-            print(f"[DEBUG] Step 2: Fetching {url2}")
-
-            headers['Referer'] = url2
-            headers['Origin'] = urlparse(url2).scheme + "://" + urlparse(url2).netloc
-            response = requests.get(url2, headers=headers, timeout=10, verify=False).text
-            print(f"[DEBUG] Step 2 response length: {len(response)} chars")
-
-            iframes = re.findall(r'iframe\s+src="([^"]*)', response, re.IGNORECASE)
-            if not iframes:
-                print("[ERROR] Step 2: No iframe src found.")
-                return None, None
-
-            url3 = iframes[0]
-            print(f"[DEBUG] Step 2: Found iframe: {url3}")
-            
-            if not url3.startswith('http'):
-                url3 = f"https://{urlparse(headers['Referer']).netloc}{url3}"
-            print(f"[DEBUG] Step 3: Fetching {url3}")
-
-            headers['Referer'] = url3
-            headers['Origin'] = urlparse(url3).scheme + "://" + urlparse(url3).netloc
-            response = requests.get(url3, headers=headers, timeout=10, verify=False).text
-            print(f"[DEBUG] Step 3 response length: {len(response)} chars")
-
-            # Extract channel_key (NOT base64 encoded)
-            channel_key_match = re.search(r'const\s+CHANNEL_KEY\s*=\s*"([^"]+)"', response)
-            if not channel_key_match:
-                channel_key_match = re.search(r'channelKey\s*=\s*["\']([^"\']+)["\']', response)
-                if not channel_key_match:
-                    print("[ERROR] Step 3: Could not find CHANNEL_KEY. Checking for other variable names...")
-                    # Look for ANY const declarations for debugging
-                    all_consts = re.findall(r'const\s+(\w+)\s*=', response)
-                    print(f"[DEBUG] All const variables found: {all_consts[:20]}")
-                    return None, None
-            channel_key = channel_key_match.group(1)
-            print(f"[DEBUG] Step 3: Found CHANNEL_KEY: {channel_key}")
-
-            # Extract the bundled parameters (XKZK bundle - base64 encoded JSON)
-            bundle_match = re.search(r'const\s+XKZK\s*=\s*"([^"]+)"', response)
-            if not bundle_match:
-                bundle_match = re.search(r'const\s+XJZ\s*=\s*"([^"]+)"', response)
-                if not bundle_match:
-                    print("[ERROR] Step 3: Could not find XKZK or XJZ bundle")
-                    return None, None
-            
-            bundle = bundle_match.group(1)
-            print(f"[DEBUG] Step 3: Found bundle (first 50 chars): {bundle[:50]}...")
-            
-            parts = json.loads(base64.b64decode(bundle).decode("utf-8"))
-            print(f"[DEBUG] Step 3: Decoded bundle keys: {list(parts.keys())}")
-            
-            # Now decode each part from base64
-            for k, v in parts.items():
-                parts[k] = base64.b64decode(v).decode("utf-8")
-
-            # Extract host array
-            host_array_match = re.search(r"host\s*=\s*\[([^\]]+)\]", response)
-            if not host_array_match:
-                print("[ERROR] Step 3: Could not find host array")
-                return None, None
-            
-            host_parts = [part.strip().strip("'\"") for part in host_array_match.group(1).split(',')]
-            host = ''.join(host_parts)
-            print(f"[DEBUG] Step 3: Found host: {host}")
-
-            # Construct the authentication script path by XORing bytes
-            bx = [40, 60, 61, 33, 103, 57, 33, 57]
-            sc = ''.join(chr(b ^ 73) for b in bx)
-
-            # Build authentication URL
-            auth_url = (
-                f'{host}{sc}?channel_id={quote_plus(channel_key)}&'
-                f'ts={quote_plus(parts["b_ts"])}&'
-                f'rnd={quote_plus(parts["b_rnd"])}&'
-                f'sig={quote_plus(parts["b_sig"])}'
-            )
-            print(f"[DEBUG] Step 4: Calling auth URL: {auth_url[:80]}...")
-
-            # Call authentication endpoint
-            auth_response = requests.get(auth_url, headers=headers, timeout=10, verify=False)
-            print(f"[DEBUG] Step 4: Auth response status: {auth_response.status_code}")
-
-            # Get server lookup URL
-            server_lookup_match = re.findall(r'fetchWithRetry\(\s*["\']([^"\']*)', response)
-            if not server_lookup_match:
-                print("[ERROR] Step 3: Could not find server lookup URL")
-                return None, None
-            server_lookup = server_lookup_match[0]
-            print(f"[DEBUG] Step 5: Found server lookup: {server_lookup}")
-
-            # Get server key
-            server_lookup_url = f"https://{urlparse(url3).netloc}{server_lookup}{channel_key}"
-            print(f"[DEBUG] Step 5: Calling server lookup: {server_lookup_url}")
-            
-            server_response = requests.get(server_lookup_url, headers=headers, timeout=10, verify=False).json()
-            server_key = server_response.get('server_key')
-            print(f"[DEBUG] Step 5: Server response: {server_response}")
-
-            if not server_key:
-                print("[ERROR] Step 5: Could not get server_key from server lookup")
-                return None, None
-
-            # Construct final HLS URL based on server_key
-            host_raw = f"https://{urlparse(url3).netloc}"
-            if server_key == "top1/cdn":
-                final_hls_url = f"https://top1.newkso.ru/top1/cdn/{channel_key}/mono.m3u8"
-            else:
-                final_hls_url = f"https://{server_key}new.newkso.ru/{server_key}/{channel_key}/mono.m3u8"
-
-            print(f"[DEBUG] Step 6: Final HLS URL: {final_hls_url}")
-
-            hls_headers = {
-                'Referer': f"{host_raw}/",
-                'Origin': host_raw,
-                'User-Agent': self.UA,
-                'Connection': 'keep-alive'
-            }
-
-            with self.cache_lock:
-                self.stream_cache[channel_id] = (final_hls_url, hls_headers, datetime.now())
-
-            print(f"[DEBUG] === Successfully resolved stream for channel {channel_id} ===\n")
-            return final_hls_url, hls_headers
+            return self._resolve_from_player_url(channel_id, url2, headers)
 
         except Exception as e:
             import traceback